@@ -1,65 +1,70 @@
 import argparse
 import collections
+import concurrent.futures
+import contextlib
+import functools
 import gzip
-import json
 import logging
-import math
 import os
-import statistics
+import sys
 import time
-from typing import Dict, List, TypedDict
+from typing import Dict, List, NamedTuple, Tuple
 
-from roaringbitmap import RoaringBitmap
+import numpy as np
+import orjson
+from roaringbitmap import RoaringBitmap, ImmutableRoaringBitmap
 from sparklines import sparklines
 from tdigest import RawTDigest
 from engineering_notation import EngNumber
 
 logger = logging.getLogger("")
 MAXCODESIZE = 0x6000 # from EIP 170
+MERKLIZE_CACHE_SIZE = 4096 # distinct (bytemap, arity, chunk sizes, max chunks) results kept by merklize_bytemap_cached
 
-def represent_contract(bytemap, codesize, chunkmap, chunk_size):
-    contract_representation = ""
-    for b in range(0, codesize):
-        if b % chunk_size == 0:
-            contract_representation += "|"
-        b_in_chunkmap = (b // chunk_size) in chunkmap
-        char = "."      # this is uninteresting: contract byte that wasn't executed nor chunked
-        if b in bytemap:
-            char = 'X'  # This is bad: executed bytecode that didn't get merklized
-        if b_in_chunkmap:
-            char = 'm'  # this is overhead: merklized but unexecuted code
-        if b in bytemap and b_in_chunkmap:
-            char = "M"  # this is OK: executed and merklized code
-        contract_representation += char
-    print(contract_representation,"\n")
-
-def clamp(n : int, min_n : int, max_n : int) -> int:
-    if n >= max_n:
-        return max_n
-    if n <= min_n:
-        return min_n
-    return n
+# a tuple rather than a dict: one of these is created per transaction
+class ContractData(NamedTuple):
+    instances: int
+    size: int
+    map: RoaringBitmap
 
-def sparkline_sizes(sorted_sizes : List) -> str :
+def represent_contract(bytemap, codesize, chunkmap, chunk_size):
+    byte_indices = np.fromiter(bytemap, dtype=np.uint32, count=len(bytemap))
+    executed = np.zeros(codesize, dtype=bool)
+    executed[byte_indices[byte_indices < codesize]] = True
+    chunk_indices = np.fromiter(chunkmap, dtype=np.uint32, count=len(chunkmap))
+    chunked = np.zeros(codesize // chunk_size + 1, dtype=bool)
+    chunked[chunk_indices[chunk_indices < len(chunked)]] = True
+    chunked = chunked[np.arange(codesize) // chunk_size]
+    # '.' is uninteresting: contract byte that wasn't executed nor chunked
+    # 'm' is overhead: merklized but unexecuted code
+    # 'X' is bad: executed bytecode that didn't get merklized
+    # 'M' is OK: executed and merklized code
+    chars = np.array(['.', 'm', 'X', 'M'])[executed * 2 + chunked]
+    contract_representation = "".join(
+        "|" + "".join(chars[c:c + chunk_size]) for c in range(0, codesize, chunk_size))
+    return contract_representation
+
+# segment sizes are small non-negative integers, so a counting sort beats a comparison sort (or merging sorted runs)
+def sort_sizes(sizes) -> np.ndarray:
+    counts = np.bincount(np.asarray(sizes, dtype=np.uint32))
+    return np.repeat(np.arange(len(counts), dtype=np.uint32), counts)
+
+def sparkline_sizes(sorted_sizes : np.ndarray) -> str :
     # sizes is sorted so we can take advantage of that to accelerate things
-    median = int(statistics.median(sorted_sizes))
+    n = len(sorted_sizes)
+    median = int(sorted_sizes[n // 2] if n % 2 else (sorted_sizes[n // 2 - 1] + sorted_sizes[n // 2]) // 2)
     bucket_size = 1
     top_bucket = 2 * median # up to median there's half of the items. Since that's typically a short range anyway, let's show twice that.
     buckets_maxcontent = range(1, top_bucket, bucket_size)  # each bucket contains values up to this, inclusive
     if len(buckets_maxcontent)==0:
         #logger.info(f"Can't bucketize, moving on. sizes={sorted_sizes}, median={median}, block={block}")
         return f"CAN'T BUCKETIZE! sizes={sorted_sizes}"
-    buckets_contents = [0 for b in buckets_maxcontent]
     maxbucket = len(buckets_maxcontent)
-    count = 0
-    for s in sorted_sizes:
-        b = math.ceil(s / bucket_size)
-        if b >= maxbucket:
-            # since the sizes are sorted, at this point we know we're finished
-            break
-        count += 1
-        b = clamp(b, 0, len(buckets_contents) - 1)
-        buckets_contents[b] += 1
+    sizes = np.asarray(sorted_sizes)
+    # since the sizes are sorted, the ones that fit in the buckets are a prefix
+    count = int(np.searchsorted(sizes, (maxbucket - 1) * bucket_size, side='right'))
+    buckets = np.clip(-(-sizes[:count].astype(np.int64) // bucket_size), 0, maxbucket - 1)  # signed, so the ceil trick works
+    buckets_contents = np.bincount(buckets, minlength=maxbucket).tolist()
 
     sl = sparklines(buckets_contents)[0]
     remaining = (1 - count / len(sorted_sizes)) * 100
@@ -68,6 +73,11 @@ def sparkline_sizes(sorted_sizes : List) -> str :
 
 # calculate the number of hashes needed to merklize the given bitmap of chunks
 def merklize(chunkmap : RoaringBitmap, arity : int, max_theoretical_chunks : int, filename : str = None) -> int:
+    nodes = np.fromiter(chunkmap, dtype=np.uint32, count=len(chunkmap))
+    return merklize_nodes(nodes, arity, max_theoretical_chunks, filename)
+
+# same as merklize, for the chunks given as a sorted array of their indices
+def merklize_nodes(nodes : np.ndarray, arity : int, max_theoretical_chunks : int, filename : str = None) -> int:
     # hashes at tree level 0 = as many as chunks
     # max hashes at tree level N = (num of level N-1) / arity
     # we assume fixed number of levels = log (max chunks) / log(arity)
@@ -78,39 +88,44 @@ def merklize(chunkmap : RoaringBitmap, arity : int, max_theoretical_chunks : int
     if filename is not None:
         dotfile = open(filename,"w")
         dotfile.write('graph  {\n')
-    num_levels = math.log(max_theoretical_chunks) / math.log(arity)
-    assert(chunkmap.max() < max_theoretical_chunks)
+    # power-of-two arities (e.g. the usual binary tree) can shift instead of dividing
+    arity_shift = arity.bit_length() - 1 if arity & (arity - 1) == 0 else None
+    # work on a sorted array of the node indices present at each level, rather than querying a bitmap per potential parent
+    assert(len(nodes) == 0 or nodes[-1] < max_theoretical_chunks)
     current_level = 0
     num_hashes = 0
     # theoretical means assuming that all the chunks are there
     theoretical_siblings = max_theoretical_chunks
-    map = chunkmap
     while theoretical_siblings >= arity:
-        # `map` contains the tree nodes at level `current_level`-1
+        # `nodes` contains the tree nodes at level `current_level`-1
         # from each n-ary set of siblings we check whether to add a parent node on the level `current_level`, into the variable `parents`
 
         if logger.isEnabledFor(logging.DEBUG):
             logger.debug("-----------")
-            logger.debug(f"L{current_level-1} pot_nodes={theoretical_siblings} actual_nodes={len(map)}")
-        parents = []
-        max_actual_parents = math.ceil((map.max() + 1) / arity) # optimization to not look for overlaps when the map is known to be empty
-                                                                # +1 because map.max() is an index, not the length
-        theoretical_parents = math.ceil(theoretical_siblings / arity)
-        hashes_missing = 0
-
-        parents_to_check = max_actual_parents
+            logger.debug(f"L{current_level-1} pot_nodes={theoretical_siblings} actual_nodes={len(nodes)}")
+        if len(nodes) == 0 and filename is None:
+            # no nodes at this level, so there are none above it either
+            break
+        # number of siblings present under each parent; a parent is present iff at least one of its siblings is
+        if arity_shift is not None:
+            theoretical_parents = (theoretical_siblings + arity - 1) >> arity_shift
+            siblings_present = np.bincount(nodes >> arity_shift)
+        else:
+            theoretical_parents = (theoretical_siblings + arity - 1) // arity
+            siblings_present = np.bincount(nodes // arity)
+        parents = np.flatnonzero(siblings_present).astype(np.uint32)
+        # each present parent needs the hashes of its missing siblings
+        hashes_missing = arity * len(parents) - len(nodes)
+        num_hashes += int(hashes_missing)
+
+        # generate visualization
         if filename is not None:
-            parents_to_check = theoretical_parents # visit all the theoretical nodes even if not currently present, so we can draw them
-        # for each possible parent, check if its siblings are present in the map
-        for p in range(0, parents_to_check):
-            siblings_start = p * arity
-            siblings_end = (p + 1) * arity
-            siblings_end = min(siblings_end, theoretical_siblings)
-            overlap = map.clamp(siblings_start, siblings_end)
-            lo = len(overlap)
-
-            # generate visualization
-            if filename is not None:
+            present = set(nodes.tolist())
+            for p in range(0, theoretical_parents):
+                siblings_start = p * arity
+                siblings_end = (p + 1) * arity
+                siblings_end = min(siblings_end, theoretical_siblings)
+                lo = siblings_present[p] if p < len(siblings_present) else 0
                 parent = f"L{current_level+1}_{p}"
                 for s in range(siblings_start, siblings_end):
                     sibling = f"L{current_level}_{s}"
@@ -118,7 +133,7 @@ def merklize(chunkmap : RoaringBitmap, arity : int, max_theoretical_chunks : int
                     if lo == 0:
                         # no sibling is present, so don't fill the bubbles
                         continue
-                    if not s in map:
+                    if not s in present:
                         dotfile.write(sibling + ' [style = "filled" fillcolor = red] \n') # missing hash that needs to be provided
                     else:
                         if current_level == 0:
@@ -126,54 +141,302 @@ def merklize(chunkmap : RoaringBitmap, arity : int, max_theoretical_chunks : int
                         else:
                             dotfile.write(sibling + ' [style = "filled" fillcolor = gray70] \n') # a node that is present (calculated by receiver)
 
-            if lo == 0:
-                # these siblings are absent in the tree, hence their parent is also absent
-                continue
-            if logger.isEnabledFor(logging.DEBUG):
-                logger.debug(f"L{current_level} checking siblings {range(siblings_start,siblings_end)} with parent {p}. Max parent expected = {max_actual_parents}")
-            assert(p < max_actual_parents) # sanity check: there's a sibling present, so its parent should be in the expected range
-
-            # at least one of these siblings is present, so the parent must be present too
-            parents.append(p)
-            hashes_missing = arity - lo
-            num_hashes += hashes_missing
-
         if logger.isEnabledFor(logging.DEBUG):
             logger.debug(f"L{current_level}: parents={parents}, num_missing_hashes={hashes_missing}")
 
-        # switch map to parents'
-        map = RoaringBitmap(parents)
+        # switch to parents'
+        nodes = parents
         theoretical_siblings = theoretical_parents
         current_level += 1
-    root = f"L{current_level}_{p}"
     if filename is not None:
+        root = f"L{current_level}_{p}"
         dotfile.write(root + ' [style = "filled" fillcolor = gray70] \n')  #fix the root's color
         dotfile.write('}')
         dotfile.close()
     return num_hashes
 
+# sorted indices of the chunks that contain any of the given sorted byte indices.
+# Byte and node indices are kept as uint32 (like the bitmaps themselves): half the memory traffic of int64
+def chunks_from_bytes(byte_indices : np.ndarray, chunk_size : int) -> np.ndarray:
+    if chunk_size == 1:
+        # special case for speed
+        return byte_indices
+    if chunk_size & (chunk_size - 1) == 0:
+        # power of two: shift instead of dividing
+        chunk_indices = byte_indices >> (chunk_size.bit_length() - 1)
+    else:
+        chunk_indices = byte_indices // chunk_size
+    # the byte indices are sorted, so the chunk indices are too: dedup in one linear sweep instead of np.unique's sort
+    if len(chunk_indices) > 1:
+        chunk_indices = chunk_indices[np.concatenate(([True], chunk_indices[1:] != chunk_indices[:-1]))]
+    return chunk_indices
+
 def chunkmap_from_bytemap(bytemap: RoaringBitmap, chunk_size: int) -> RoaringBitmap:
-    max_contract_chunk = bytemap.max() // chunk_size
     if chunk_size == 1:
         # special case for speed
         chunkmap = bytemap
     else:
-        chunkmap = RoaringBitmap()
-        for c in range(0, max_contract_chunk + 1):
-            chunk_start = c * chunk_size
-            chunk_stop = (c + 1) * chunk_size
-            # chunkrange = range(chunk_start, chunk_stop)
-            # z1 = len(bytemap.clamp(chunk_start, chunk_stop)) == 0 #fastest
-            # z2 = bytemap.intersection_len(chunkrange) == 0
-            # z3 = bytemap.isdisjoint(chunkrange)
-            # assert(z1 == z2 and z2 == z3)
-            # chunkificator = chunkificators[c]
-            # if not bytemap.isdisjoint(chunkificator):
-            overlap = bytemap.clamp(chunk_start, chunk_stop)
-            if len(overlap) != 0:
-                chunkmap.add(c)
+        # pull the whole bitmap into a sorted array at once instead of querying it chunk by chunk
+        byte_indices = np.fromiter(bytemap, dtype=np.uint32, count=len(bytemap))
+        chunkmap = RoaringBitmap(chunks_from_bytes(byte_indices, chunk_size).tolist())
     return chunkmap
 
+# chunkify and merklize the executed bytes in one go, without building a chunkmap in between.
+# Returns the number of chunks and the number of hashes.
+def merklize_bytemap(byte_indices : np.ndarray, arity : int, chunk_size : int, max_theoretical_chunks : int) -> Tuple[int, int]:
+    nodes = chunks_from_bytes(byte_indices, chunk_size)
+    return len(nodes), merklize_nodes(nodes, arity, max_theoretical_chunks)
+
+# popular contracts tend to execute the same paths block after block, so their bytemaps repeat.
+# The bytemap must be frozen to be hashable; freezing is far cheaper than walking the tree again.
+# Returns (num_chunks, num_hashes) for each chunk size.
+@functools.lru_cache(maxsize=MERKLIZE_CACHE_SIZE)
+def merklize_bytemap_cached(bytemap : ImmutableRoaringBitmap, arity : int, chunk_sizes : Tuple[int, ...], max_theoretical_chunks : Tuple[int, ...]) -> Tuple[Tuple[int, int], ...]:
+    # read the bitmap (and its cardinality) once for all the chunk sizes
+    byte_indices = np.fromiter(bytemap, dtype=np.uint32, count=len(bytemap))
+    return tuple(merklize_bytemap(byte_indices, arity, chunk_size, max_chunks)
+                 for chunk_size, max_chunks in zip(chunk_sizes, max_theoretical_chunks))
+
+class FileResult(NamedTuple):
+    output: str                 # what process_file has left to print, to be shown by the parent in file order
+    blocks: int
+    executed_bytes: int
+    chunks: List[int]           # one element per chunk size
+    hashes: List[int]           # one element per chunk size
+    segsizes: np.ndarray        # sorted; only filled in with segment_stats
+
+# chunkify and merklize all the blocks in a trace file. Runs in a worker process, so it doesn't touch any global totals
+def process_file(f : str, chunk_sizes : List[int], hash_sizes : List[int], arity : int, detail_level : int, segment_stats : bool, stream : bool = False) -> FileResult:
+    # output is collected and written a block at a time (or all at once, when not streaming) instead of print()ing each line
+    out : List[str] = []
+    t0 = time.time()
+    blocks: int = 0
+    with gzip.open(f, 'rb') as gzf:
+        block_traces = orjson.loads(gzf.read())
+    file_executed_bytes = 0
+    file_hashes: List[int] = [0 for x in chunk_sizes]  # one element per chunk size
+    file_chunks: List[int] = [0 for x in chunk_sizes]  # one element per chunk size
+    # part of the merklization cache key, hence tuples
+    chunk_sizes_key : Tuple[int, ...] = tuple(chunk_sizes)
+    # depends only on the chunk size, so it's computed once rather than for every contract
+    max_theoretical_chunks : Tuple[int, ...] = tuple(MAXCODESIZE // chunk_size for chunk_size in chunk_sizes)  # one element per chunk size
+    file_block_segsizes : List[np.ndarray] = []
+    file_segsizes : np.ndarray = np.empty(0, dtype=np.uint32)
+    file_segsize_digest = RawTDigest()
+    for block in list(block_traces):
+        # pop the block so its traces can be freed as soon as it's processed
+        traces = block_traces.pop(block)
+        blocks += 1
+        if len(traces)==0:
+            logger.debug(f"Block {block} is empty")
+            continue
+        dict_contracts : Dict[str, ContractData] = {}
+        reused_contracts = 0
+        empty_transactions = 0
+        num_bytes_code = 0
+        num_bytes_chunks = 0
+        block_segsizes : np.ndarray = np.empty(0, dtype=np.uint32)
+        if segment_stats:
+            # the number of segments in the block is known upfront, so their sizes can go straight into a preallocated array
+            block_segsizes = np.empty(sum(len(t["Segments"]) for t in traces if t["Tx"] is not None), dtype=np.uint32)
+        block_numsegments = 0
+        for t in traces:
+            tx_hash: str = t["Tx"]
+            if tx_hash is None:
+                # this was a transaction without opcodes - a value transfer
+                empty_transactions += 1
+                continue
+            logger.debug(f"Tx {t['TxAddr']} has {len(t['Segments'])} segments")
+            codehash : str = t["CodeHash"]
+            data = dict_contracts.get(codehash)
+            if data is None:
+                bytemap = RoaringBitmap()
+                instances = 1
+                size = t['CodeSize']
+            else:
+                reused_contracts += 1
+                bytemap = data.map
+                instances = data.instances+1
+                size = data.size
+
+            segments = [(s["Start"], s["End"]) for s in t["Segments"]]
+            # loops execute the same segments over and over, but each distinct one only needs to be set once
+            for start, end in set(segments):
+                # RoaringBitmap recognizes range objects and sets the whole run at once
+                bytemap.update(range(start, end+1))
+            tx_segsizes: List[int] = []
+            if segment_stats:
+                tx_segsizes = [end - start + 1 for start, end in segments]
+            dict_contracts[codehash] = ContractData(instances=instances, size=size, map=bytemap)
+            #del t["Segments"]
+
+            # transaction-level segment stats
+            if segment_stats:
+                # no need to sort here: the block's sizes get sorted all together
+                block_segsizes[block_numsegments:block_numsegments + len(tx_segsizes)] = tx_segsizes
+            block_numsegments += len(t['Segments'])
+            if detail_level >= 3:
+                segstats = f"seg_sizes:{sparkline_sizes(sort_sizes(tx_segsizes))}" if segment_stats else ""
+                out.append(f"Block {block} "
+                           f"codehash={codehash} "
+                           f"tx={t['TxAddr']} "
+                           f"segs={len(tx_segsizes)} "
+                           + segstats + "\n"
+                           )
+
+        # coherency check: did we classify all the transactions?
+        executed_transactions = sum([c.instances for c in dict_contracts.values()])
+        assert(len(traces) == executed_transactions + empty_transactions)
+
+        if executed_transactions == 0:
+            # There were no transactions with segments, so nothing to calculate for this block
+            logger.debug(f"Block {block} had no segments")
+            continue
+
+        block_executed_bytes : int = 0
+        block_hashes : List[int] = [0 for x in chunk_sizes] # one element per chunk size
+        block_chunks : List[int] = [0 for x in chunk_sizes] # one element per chunk size
+
+        # chunkification of the contracts executed in the block
+        for codehash, data in dict_contracts.items():
+            instances, codesize, bytemap = data
+            executed_bytes = len(bytemap)
+            block_executed_bytes += executed_bytes
+            file_executed_bytes += executed_bytes
+            # the bytemap is complete at this point, so freeze it once: besides being hashable for the merklization cache,
+            # the frozen copy has its containers trimmed to size. (This roaringbitmap has no run containers, so there is no run_optimize())
+            frozen_bytemap = bytemap.freeze()
+            merklizations = merklize_bytemap_cached(frozen_bytemap, arity, chunk_sizes_key, max_theoretical_chunks)
+            for csi in range(0, len(chunk_sizes)):
+                chunk_size = chunk_sizes[csi]
+                num_chunks, merklization_hashes = merklizations[csi]
+                chunked_bytes = num_chunks * chunk_size
+
+                # make it easier to see outliers
+                highlighter : str = ""
+                if chunked_bytes < executed_bytes: # sanity check
+                    logger.error(f"Contract {codehash} in block {block} executes {executed_bytes} but merklizes to {chunked_bytes}")
+                    highlighter = "\t\t" + "??????"
+                    out.append(represent_contract(bytemap, codesize, chunkmap_from_bytemap(bytemap, chunk_size), chunk_size) + "\n\n")
+
+                if detail_level >=2:
+                    chunk_waste = ((chunked_bytes - executed_bytes) / chunked_bytes) * 100
+                    out.append(f"Contract {codehash}: "
+                               f"{instances} txs "
+                               f"size={codesize}\t"
+                               f"executed={executed_bytes}\t"
+                               f"chunksize={chunk_size}\t"
+                               f"chunks={num_chunks}={chunked_bytes}B\t"
+                               f"wasted={chunk_waste:.0f}%\t"
+                               f"hashes={merklization_hashes}"
+                               +highlighter + "\n"
+                    )
+
+                block_chunks[csi] += num_chunks
+                block_hashes[csi] += merklization_hashes
+                file_chunks[csi] += num_chunks
+                file_hashes[csi] += merklization_hashes
+
+        # block-level merklization stats
+        if detail_level >=1:
+            out.append(f"Block {block}: "
+                f"exec={block_executed_bytes / 1024:.1f}K\t"
+            )
+            if segment_stats:
+                # sparkline_sizes needs them sorted (middle-element median, searchsorted prefix)
+                block_segsizes = sort_sizes(block_segsizes)
+                out.append(
+                    f"segs={len(block_segsizes)}\t"
+                    f"seg_sizes:{sparkline_sizes(block_segsizes)}\n")
+                file_block_segsizes.append(block_segsizes)
+            else:
+                out.append("\n")
+
+            for csi in range(len(chunk_sizes)):  # we need the index
+                chunk_size = chunk_sizes[csi]
+                chunks = block_chunks[csi]
+                hashes = block_hashes[csi]
+                block_chunk_bytes = chunks * chunk_size
+                block_merklization_chunk_overhead = (block_chunk_bytes - block_executed_bytes) / block_executed_bytes * 100
+                out.append(
+                    f"\t"
+                    f"chunksize={chunk_size:2}\t"
+                    f"chunk_oh={block_merklization_chunk_overhead :5.1f}% ({EngNumber(chunks)} chunks) + {EngNumber(hashes)} hashes\t\n"
+                    # ,end=''
+                )
+                for hash_size in hash_sizes:
+                    block_hash_bytes = hashes * hash_size
+                    block_merklization_hash_overhead = block_hash_bytes / block_executed_bytes * 100
+                    block_merklization_bytes = block_chunk_bytes + block_hash_bytes
+                    block_merklization_overhead = (block_merklization_bytes - block_executed_bytes) / block_executed_bytes * 100
+                    out.append(
+                        f"\t\t"
+                        f"hashsize={hash_size:2}"
+                        f"\t hash_oh={block_merklization_hash_overhead :5.1f}%"
+                        f"\t\ttotal_oh={block_merklization_overhead :5.1f}%\n"
+                        # f"mkztn={block_merklization_bytes / 1024:.1f} K "
+                        # f"= {block_chunk_bytes / 1024:.1f} K ({EngNumber(chunks)} chunks) + {block_hash_bytes / 1024:.1f} K ({EngNumber(hashes)} hashes)"
+                    )
+        if stream:
+            # in-process, there's no ordering to keep, so each block is shown as soon as it's done
+            sys.stdout.write("".join(out))
+            out.clear()
+    del block_traces  # help the garbage collector?
+
+
+    # file-level merklization stats
+    out.append(
+        f"file {f}: "
+        f"blocks={blocks}\t"
+        f"exec={file_executed_bytes / 1024:.1f}K\t"
+    )
+    if segment_stats:
+        # sparkline_sizes needs them sorted (middle-element median, searchsorted prefix)
+        file_segsizes = sort_sizes(np.concatenate(file_block_segsizes) if file_block_segsizes else [])
+        out.append(
+            f"segs={len(file_segsizes)}\t"
+            f"seg_sizes:{sparkline_sizes(file_segsizes)}\n")
+    else:
+        out.append("\n")
+
+    for csi in range(len(chunk_sizes)): # we need the index
+        chunk_size = chunk_sizes[csi]
+        chunks = file_chunks[csi]
+        hashes = file_hashes[csi]
+        file_chunk_bytes = chunks * chunk_size
+        file_merklization_chunk_overhead = (file_chunk_bytes - file_executed_bytes) / file_executed_bytes * 100
+        out.append(
+            f"\t"
+            f"chunksize={chunk_size:2}\t"
+            f"chunk_oh={file_merklization_chunk_overhead :5.1f}% ({EngNumber(chunks)} chunks) + {EngNumber(hashes)} hashes\t\n"
+            #,end=''
+        )
+        for hash_size in hash_sizes:
+            file_hash_bytes = hashes * hash_size
+            file_merklization_hash_overhead = file_hash_bytes / file_executed_bytes * 100
+            file_merklization_bytes = file_chunk_bytes + file_hash_bytes
+            file_merklization_overhead = (file_merklization_bytes - file_executed_bytes) / file_executed_bytes * 100
+            out.append(
+                f"\t\t"
+                f"hashsize={hash_size:2}"
+                f"\t hash_oh={file_merklization_hash_overhead :5.1f}%"
+                f"\t\ttotal_oh={file_merklization_overhead :5.1f}%\n"
+                #f"mkztn={file_merklization_bytes / 1024:.1f} K "
+                #f"= {file_chunk_bytes / 1024:.1f} K ({EngNumber(chunks)} chunks) + {file_hash_bytes / 1024:.1f} K ({EngNumber(hashes)} hashes)"
+            )
+    # log speed
+    t_file = time.time() - t0
+    logger.info(f"file {f}: "
+                 f"{blocks} blocks in {t_file:.0f} seconds = {blocks/t_file:.1f}bps.")
+    return FileResult(output="".join(out), blocks=blocks, executed_bytes=file_executed_bytes,
+                      chunks=file_chunks, hashes=file_hashes, segsizes=file_segsizes)
+
+def positive_int(value : str) -> int:
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return n
+
 def main():
     parser = argparse.ArgumentParser(
         description='Reads a directory or multiple files containing segments from transactions, and applies fixed chunking to them to calculate the resulting witness sizes',
@@ -187,15 +450,16 @@ def main():
     parser.add_argument("-j", "--job_ID", help="ID to distinguish in parallel runs", type=int, default=None)
     parser.add_argument("-d", "--detail_level", help="3=transaction, 2=contract, 1=block, 0=file. One level implies the lower ones.", type=int, default=1)
     parser.add_argument("-g", "--segment_stats", help="Whether to calculate and show segments stats", default=False, action='store_true')
+    parser.add_argument("-p", "--processes", help="Number of trace files to process in parallel. None means one per CPU", type=positive_int, default=None)
 
     args = parser.parse_args()
 
     loglevel_num = getattr(logging, args.log.upper(), None)
     if not isinstance(loglevel_num, int):
         raise ValueError(f"Invalid log level: {args.loglevel}")
-    logging.basicConfig(level=loglevel_num, format= \
+    log_config = dict(level=loglevel_num, format= \
         ("" if args.job_ID is None else f'{args.job_ID:4} | ') + '%(asctime)s %(message)s', datefmt='%H:%M:%S')
-    logger = logging.getLogger("")
+    logging.basicConfig(**log_config)
 
     # help the IDE's autocomplete and typing
     chunk_sizes : List[int] = args.chunk_size
@@ -204,11 +468,10 @@ def main():
     arity : int = args.arity
     detail_level : int = args.detail_level
     segment_stats : bool = args.segment_stats
+    processes : int = args.processes if args.processes is not None else (os.cpu_count() or 1)
 
     del args
 
-    contract_data = TypedDict('contract_data', {'instances':int, 'size':int, 'map':RoaringBitmap}, total=True)
-
     Chunkification_record = collections.namedtuple('Chunkification_record', [])
 
     segment_sizes : List[int] = []
@@ -222,266 +485,68 @@ def main():
     total_chunks: List[int] = [0 for x in chunk_sizes]  # one element per chunk size
     total_segsize_digest = RawTDigest()
     total_blocks = 0
-    block : int
     print(f"Chunking for tree arity={arity}, chunk size={chunk_sizes}, hash size={hash_sizes}")
-    for f in files:
-        t0 = time.time()
-        blocks: int = 0
-        with gzip.open(f, 'rb') as gzf:
-            block_traces = json.load(gzf)
-        file_executed_bytes = 0
-        file_hashes: List[int] = [0 for x in chunk_sizes]  # one element per chunk size
-        file_chunks: List[int] = [0 for x in chunk_sizes]  # one element per chunk size
-        file_segsizes : List[int] = []
-        file_segsize_digest = RawTDigest()
-        for block in block_traces:
-            traces = block_traces[block]
-            blocks += 1
-            total_blocks +=1
-            if len(traces)==0:
-                logger.debug(f"Block {block} is empty")
-                continue
-            dict_contracts : Dict[str, contract_data] = {}
-            reused_contracts = 0
-            empty_transactions = 0
-            num_bytes_code = 0
-            num_bytes_chunks = 0
-            block_segsizes : List[int] = []
-            block_numsegments = 0
-            for t in traces:
-                tx_hash: str = t["Tx"]
-                if tx_hash is None:
-                    # this was a transaction without opcodes - a value transfer
-                    empty_transactions += 1
-                    continue
-                logger.debug(f"Tx {t['TxAddr']} has {len(t['Segments'])} segments")
-                codehash : str = t["CodeHash"]
-                data = dict_contracts.get(codehash)
-                if data is None:
-                    bytemap = RoaringBitmap()
-                    instances = 1
-                    size = t['CodeSize']
-                else:
-                    reused_contracts += 1
-                    bytemap = data['map']
-                    instances = data['instances']+1
-                    size = data['size']
-
-                tx_segsizes: List[int] = []
-                for s in t["Segments"]:
-                    start = s["Start"]
-                    end = s["End"]
-                    range_code = range(start, end+1)
-                    bytemap.update(range_code)
-                    if segment_stats:
-                        length = end - start + 1
-                        tx_segsizes.append(length)
-                block_numsegments += len(t['Segments'])
-                dict_contracts[codehash] = contract_data(instances=instances, size=size, map=bytemap)
-                #del t["Segments"]
-
-                # transaction-level segment stats
-                if segment_stats:
-                    tx_segsizes = sorted(tx_segsizes)
-                    block_segsizes += tx_segsizes
-                if detail_level >= 3:
-                    segstats = f"seg_sizes:{sparkline_sizes(tx_segsizes)}" if segment_stats else ""
-                    print(f"Block {block} "
-                          f"codehash={codehash} "
-                          f"tx={t['TxAddr']} "
-                          f"segs={len(tx_segsizes)} "
-                          + segstats
-                          )
-
-            # coherency check: did we classify all the transactions?
-            executed_transactions = sum([c["instances"] for c in dict_contracts.values()])
-            assert(len(traces) == executed_transactions + empty_transactions)
-
-            if executed_transactions == 0:
-                # There were no transactions with segments, so nothing to calculate for this block
-                logger.debug(f"Block {block} had no segments")
+    process = functools.partial(process_file, chunk_sizes=chunk_sizes, hash_sizes=hash_sizes, arity=arity,
+                                detail_level=detail_level, segment_stats=segment_stats, stream=processes == 1)
+    # files are independent, so they can be processed concurrently; map() still returns them in order.
+    # Workers set up logging like the parent, since spawned ones (the default on macOS and Windows) don't inherit it
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=processes,
+                                                      initializer=functools.partial(logging.basicConfig, **log_config)
+                                                      ) if processes > 1 else contextlib.nullcontext()
+    with executor:
+        results = executor.map(process, files) if processes > 1 else map(process, files)
+        for res in results:
+            sys.stdout.write(res.output)
+            file_segsizes = res.segsizes
+            total_blocks += res.blocks
+            total_executed_bytes += res.executed_bytes
+            for csi in range(len(chunk_sizes)):
+                total_chunks[csi] += res.chunks[csi]
+                total_hashes[csi] += res.hashes[csi]
+
+            # global running stats
+            if len(files) < 2:
                 continue
-
-            block_executed_bytes : int = 0
-            block_hashes : List[int] = [0 for x in chunk_sizes] # one element per chunk size
-            block_chunks : List[int] = [0 for x in chunk_sizes] # one element per chunk size
-
-            # chunkification of the contracts executed in the block
-            for codehash, data in dict_contracts.items():
-                instances = data['instances']
-                codesize = data['size']
-                bytemap = data['map']
-                executed_bytes = len(bytemap)
-                block_executed_bytes += executed_bytes
-                file_executed_bytes += executed_bytes
-                total_executed_bytes += executed_bytes
-                for csi in range(0, len(chunk_sizes)):
-                    chunk_size = chunk_sizes[csi]
-                    #maxcode_chunk = MAXCODESIZE // chunk_size
-                    chunkmap = chunkmap_from_bytemap(bytemap, chunk_size)
-                    max_theoretical_chunks = MAXCODESIZE // chunk_size
-                    merklization_hashes = merklize(chunkmap, arity, max_theoretical_chunks)
-
-                    num_chunks = len(chunkmap)
-                    chunked_bytes = num_chunks * chunk_size
-
-                    # make it easier to see outliers
-                    highlighter : str = ""
-                    if chunked_bytes < executed_bytes: # sanity check
-                        logger.error(f"Contract {codehash} in block {block} executes {executed_bytes} but merklizes to {chunked_bytes}")
-                        highlighter = "\t\t" + "??????"
-                        represent_contract(bytemap, codesize, chunkmap, chunk_size)
-
-                    if detail_level >=2:
-                        chunk_waste = ((chunked_bytes - executed_bytes) / chunked_bytes) * 100
-                        print(f"Contract {codehash}: "
-                              f"{instances} txs "
-                              f"size={codesize}\t"
-                              f"executed={executed_bytes}\t"
-                              f"chunksize={chunk_size}\t"
-                              f"chunks={num_chunks}={chunked_bytes}B\t"
-                              f"wasted={chunk_waste:.0f}%\t"
-                              f"hashes={merklization_hashes}"
-                              +highlighter
-                        )
-
-                    block_chunks[csi] += num_chunks
-                    block_hashes[csi] += merklization_hashes
-                    file_chunks[csi] += num_chunks
-                    file_hashes[csi] += merklization_hashes
-                    total_chunks[csi] += num_chunks
-                    total_hashes[csi] += merklization_hashes
-
-            # block-level merklization stats
-            if detail_level >=1:
-                print(f"Block {block}: "
-                    f"exec={block_executed_bytes / 1024:.1f}K\t"
-                    , end=''
-                )
-                if segment_stats:
-                    # sorting helps other steps be faster (e.g., stats.median)
-                    block_segsizes = sorted(block_segsizes)
-                    print(
-                        f"segs={len(block_segsizes)}\t"
-                        f"seg_sizes:{sparkline_sizes(block_segsizes)}")
-                    file_segsizes += block_segsizes
-                else:
-                    print()
-
-                for csi in range(len(chunk_sizes)):  # we need the index
-                    chunk_size = chunk_sizes[csi]
-                    chunks = block_chunks[csi]
-                    hashes = block_hashes[csi]
-                    block_chunk_bytes = chunks * chunk_size
-                    block_merklization_chunk_overhead = (block_chunk_bytes - block_executed_bytes) / block_executed_bytes * 100
-                    print(
-                        f"\t"
-                        f"chunksize={chunk_size:2}\t"
-                        f"chunk_oh={block_merklization_chunk_overhead :5.1f}% ({EngNumber(chunks)} chunks) + {EngNumber(hashes)} hashes\t"
-                        # ,end=''
-                    )
-                    for hash_size in hash_sizes:
-                        block_hash_bytes = hashes * hash_size
-                        block_merklization_hash_overhead = block_hash_bytes / block_executed_bytes * 100
-                        block_merklization_bytes = block_chunk_bytes + block_hash_bytes
-                        block_merklization_overhead = (block_merklization_bytes - block_executed_bytes) / block_executed_bytes * 100
-                        print(
-                            f"\t\t"
-                            f"hashsize={hash_size:2}"
-                            f"\t hash_oh={block_merklization_hash_overhead :5.1f}%"
-                            f"\t\ttotal_oh={block_merklization_overhead :5.1f}%"
-                            # f"mkztn={block_merklization_bytes / 1024:.1f} K "
-                            # f"= {block_chunk_bytes / 1024:.1f} K ({EngNumber(chunks)} chunks) + {block_hash_bytes / 1024:.1f} K ({EngNumber(hashes)} hashes)"
-                        )
-        del block_traces  # help the garbage collector?
-
-
-        # file-level merklization stats
-        print(
-            f"file {f}: "
-            f"blocks={blocks}\t"
-            f"exec={file_executed_bytes / 1024:.1f}K\t"
-            , end=''
-        )
-        if segment_stats:
-            # sorting helps other steps be faster (e.g., stats.median)
-            file_segsizes = sorted(file_segsizes)
-            print(
-                f"segs={len(file_segsizes)}\t"
-                f"seg_sizes:{sparkline_sizes(file_segsizes)}")
-        else:
-            print()
-
-        for csi in range(len(chunk_sizes)): # we need the index
-            chunk_size = chunk_sizes[csi]
-            chunks = file_chunks[csi]
-            hashes = file_hashes[csi]
-            file_chunk_bytes = chunks * chunk_size
-            file_merklization_chunk_overhead = (file_chunk_bytes - file_executed_bytes) / file_executed_bytes * 100
-            print(
-                f"\t"
-                f"chunksize={chunk_size:2}\t"
-                f"chunk_oh={file_merklization_chunk_overhead :5.1f}% ({EngNumber(chunks)} chunks) + {EngNumber(hashes)} hashes\t"
-                #,end=''
+            out : List[str] = []
+            out.append(
+                f"running total: "
+                f"blocks={total_blocks}\t"
             )
-            for hash_size in hash_sizes:
-                file_hash_bytes = hashes * hash_size
-                file_merklization_hash_overhead = file_hash_bytes / file_executed_bytes * 100
-                file_merklization_bytes = file_chunk_bytes + file_hash_bytes
-                file_merklization_overhead = (file_merklization_bytes - file_executed_bytes) / file_executed_bytes * 100
-                print(
-                    f"\t\t"
-                    f"hashsize={hash_size:2}"
-                    f"\t hash_oh={file_merklization_hash_overhead :5.1f}%"
-                    f"\t\ttotal_oh={file_merklization_overhead :5.1f}%"
-                    #f"mkztn={file_merklization_bytes / 1024:.1f} K "
-                    #f"= {file_chunk_bytes / 1024:.1f} K ({EngNumber(chunks)} chunks) + {file_hash_bytes / 1024:.1f} K ({EngNumber(hashes)} hashes)"
-                )
-        # log speed
-        t_file = time.time() - t0
-        logger.info(f"file {f}: "
-                     f"{blocks} blocks in {t_file:.0f} seconds = {blocks/t_file:.1f}bps.")
-
-        # global running stats
-        if len(files) < 2:
-            continue
-        print(
-            f"running total: "
-            f"blocks={total_blocks}\t"
-            ,end=''
-        )
-        if segment_stats:
-            for s in file_segsizes:
-                total_segsize_digest.insert(s)
-            print(f"\testimated median segsize:{total_segsize_digest.quantile(0.5):.1f}")
-        else:
-            print()
-
-        for csi in range(len(chunk_sizes)): # we need the index
-            chunk_size = chunk_sizes[csi]
-            chunks = total_chunks[csi]
-            hashes = total_hashes[csi]
-            total_chunk_bytes = chunks * chunk_size
-            total_merklization_chunk_overhead = (total_chunk_bytes - total_executed_bytes) / total_executed_bytes * 100
-            print(
-                f"\t"
-                f"chunksize={chunk_size:2}\t"
-                f"chunk_oh={total_merklization_chunk_overhead :5.1f}% ({EngNumber(chunks)} chunks) + {EngNumber(hashes)} hashes\t"
-                #,end=''
-            )
-            for hash_size in hash_sizes:
-                total_hash_bytes = hashes * hash_size
-                total_merklization_hash_overhead = total_hash_bytes / total_executed_bytes * 100
-                total_merklization_bytes = total_chunk_bytes + total_hash_bytes
-                total_merklization_overhead = (total_merklization_bytes - total_executed_bytes) / total_executed_bytes * 100
-                print(
-                    f"\t\t"
-                    f"hashsize={hash_size:2}"
-                    f"\t hash_oh={total_merklization_hash_overhead :5.1f}% ({EngNumber(hashes)} hashes)"
-                    f"\t\ttotal_oh={total_merklization_overhead :5.1f}%\t"
-                    #f"mkztn={total_merklization_bytes / 1024:.1f} K "
-                    #f"= {total_chunk_bytes / 1024:.1f} K ({EngNumber(chunks)} chunks) + {total_hash_bytes / 1024:.1f} K ({EngNumber(hashes)} hashes)"
+            if segment_stats:
+                # segment sizes repeat a lot: insert each distinct size once, weighted by how many times it appears
+                sizes, counts = np.unique(file_segsizes, return_counts=True)
+                for s, c in zip(sizes.tolist(), counts.tolist()):
+                    total_segsize_digest.insert(s, c)
+                out.append(f"\testimated median segsize:{total_segsize_digest.quantile(0.5):.1f}\n")
+            else:
+                out.append("\n")
+
+            for csi in range(len(chunk_sizes)): # we need the index
+                chunk_size = chunk_sizes[csi]
+                chunks = total_chunks[csi]
+                hashes = total_hashes[csi]
+                total_chunk_bytes = chunks * chunk_size
+                total_merklization_chunk_overhead = (total_chunk_bytes - total_executed_bytes) / total_executed_bytes * 100
+                out.append(
+                    f"\t"
+                    f"chunksize={chunk_size:2}\t"
+                    f"chunk_oh={total_merklization_chunk_overhead :5.1f}% ({EngNumber(chunks)} chunks) + {EngNumber(hashes)} hashes\t\n"
+                    #,end=''
                 )
+                for hash_size in hash_sizes:
+                    total_hash_bytes = hashes * hash_size
+                    total_merklization_hash_overhead = total_hash_bytes / total_executed_bytes * 100
+                    total_merklization_bytes = total_chunk_bytes + total_hash_bytes
+                    total_merklization_overhead = (total_merklization_bytes - total_executed_bytes) / total_executed_bytes * 100
+                    out.append(
+                        f"\t\t"
+                        f"hashsize={hash_size:2}"
+                        f"\t hash_oh={total_merklization_hash_overhead :5.1f}% ({EngNumber(hashes)} hashes)"
+                        f"\t\ttotal_oh={total_merklization_overhead :5.1f}%\t\n"
+                        #f"mkztn={total_merklization_bytes / 1024:.1f} K "
+                        #f"= {total_chunk_bytes / 1024:.1f} K ({EngNumber(chunks)} chunks) + {total_hash_bytes / 1024:.1f} K ({EngNumber(hashes)} hashes)"
+                    )
+            sys.stdout.write("".join(out))
 
 if __name__ == "__main__":
     main()